@@ -42,9 +42,10 @@ def network_cleanup() -> None:
                 .splitlines()
             )
             if configured_ifaces:
-                for iface in configured_ifaces:
-                    LOG.debug(f"Deconfiguring interface: {iface}")
-                    run(["ifdown", iface], stdout=DEVNULL)
+                LOG.debug(
+                    f"Deconfiguring interfaces: {', '.join(configured_ifaces)}"
+                )
+                run(["ifdown", *configured_ifaces], stdout=DEVNULL)
             # delete the file
             net_config_file.unlink()
             LOG.debug(f"Configuration file {net_config_file} was removed")
@@ -52,9 +53,11 @@ def network_cleanup() -> None:
             LOG.error(f"Failed to cleanup network configuration: {err}")
 
     udev_rules_file = Path("/etc/udev/rules.d/70-persistent-net.rules")
-    if udev_rules_file.exists():
-        LOG.debug(f"Configuration file {udev_rules_file} was removed")
+    try:
         udev_rules_file.unlink()
+        LOG.debug(f"Configuration file {udev_rules_file} was removed")
+    except FileNotFoundError:
+        pass
 
 
 def handle(*args) -> None:
@@ -16,14 +16,15 @@
 # This must be done during each boot to avoid interferring with VyOS CLI config.
 
 import logging
-from json import loads as json_loads
-from os import sync
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from errno import EINVAL, ENOSYS, EOPNOTSUPP, EXDEV
 from pathlib import Path
-from shlex import split as shlex_split
-from shutil import copy, rmtree
+from shutil import Error, copyfile, copyfileobj, copytree, rmtree
+from stat import S_IMODE, S_ISDIR, S_ISREG
 from subprocess import run
-
-from psutil import disk_partitions
+from typing import Optional
 
 from cloudinit.cloud import Cloud
 from cloudinit.settings import PER_INSTANCE
@@ -46,6 +47,8 @@ DIR_INSTALLATION: str = "/mnt/installation"
 DIR_DST_ROOT: str = f"{DIR_INSTALLATION}/disk_dst"
 DIR_KERNEL_SRC: str = "/boot/"
 FILE_ROOTFS_SRC: str = "/usr/lib/live/mount/medium/live/filesystem.squashfs"
+# devices which use a "p" prefix before a partition number
+PARTITION_P_DEVICES: tuple[str, ...] = ("nvme", "mmcblk", "loop")
 
 DEFAULT_BOOT_VARS: dict[str, str] = {
     "timeout": "5",
@@ -60,61 +63,195 @@ LOG = logging.getLogger(__name__)
 frequency = PER_INSTANCE
 
 
-def disks_size() -> "dict[str, int]":
-    """Get a dictionary with physical disks and their sizes
-    Returns:
-        dict[str, int]: a dictionary with name: size mapping
-    """
-    disks_size: dict[str, int] = {}
-    lsblk: str = run(shlex_split("lsblk -Jbp"), capture_output=True).stdout.decode()
-    blk_list = json_loads(lsblk)
-    for device in blk_list.get("blockdevices"):
-        if device["type"] == "disk":
-            disks_size.update({device["name"]: device["size"]})
-    return disks_size
-
-
 def find_disk() -> "tuple[str, int]":
     """Find a target disk for installation
     Returns:
         tuple[str, int]: disk name and size in bytes
     """
-    # check for available disks
-    disks_available: dict[str, int] = disks_size()
-    if not disks_available:
-        return "", 0
-
-    for disk_name, disk_size in disks_available.copy().items():
+    # whole devices only, one "NAME TYPE SIZE" line per device
+    lsblk: str = run(
+        ["lsblk", "-rnbdpo", "NAME,TYPE,SIZE"],
+        capture_output=True,
+        text=True,
+    ).stdout
+    # return the first suitable disk
+    for device in lsblk.splitlines():
+        disk_name, disk_type, disk_size = device.split()
         # minimum 2 GB
-        if disk_size > 2147483648:
-            return disk_name, disk_size
+        if disk_type == "disk" and int(disk_size) > 2147483648:
+            return disk_name, int(disk_size)
 
     return "", 0
 
 
+def copy_file(src: str, dst: str) -> None:
+    """Copy a file keeping the data in kernel space where possible
+
+    Args:
+        src (str): a path to the source file
+        dst (str): a path to the destination file
+
+    Raises:
+        OSError: if the file could not be copied completely
+    """
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        src_fd: int = src_file.fileno()
+        dst_fd: int = dst_file.fileno()
+        src_stat = os.fstat(src_fd)
+        os.fchmod(dst_fd, src_stat.st_mode)
+        # copy_file_range() also allows a filesystem to clone data instead
+        # of copying it, sendfile() works between any filesystems
+        kernel_copy_methods = (
+            lambda count: os.copy_file_range(src_fd, dst_fd, count),
+            lambda count: os.sendfile(dst_fd, src_fd, None, count),
+        )
+        copied: int = 0
+        for kernel_copy in kernel_copy_methods:
+            try:
+                while copied < src_stat.st_size:
+                    chunk: int = kernel_copy(src_stat.st_size - copied)
+                    # some filesystems report 0 bytes instead of an error,
+                    # so continue with the next method
+                    if not chunk:
+                        break
+                    copied += chunk
+            except OSError as err:
+                if err.errno not in (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV):
+                    raise
+            if copied == src_stat.st_size:
+                return
+        # the last resort, copying continues from the current offset
+        copyfileobj(src_file, dst_file)
+        if dst_file.tell() != src_stat.st_size:
+            raise OSError(
+                f"{src} copied incompletely: {dst_file.tell()} of "
+                f"{src_stat.st_size} bytes"
+            )
+
+
+def copy_with_owner(src: str, dst: str) -> str:
+    """Copy a file with its mode, timestamps and ownership (like "cp -p").
+    Special files (FIFOs, sockets, devices) are recreated, like "cp -R" does
+
+    Args:
+        src (str): a path to the source file
+        dst (str): a path to the destination file
+
+    Returns:
+        str: a path to the destination file
+    """
+    src_stat = os.lstat(src)
+    if S_ISREG(src_stat.st_mode):
+        copyfile(src, dst)
+    else:
+        os.mknod(dst, src_stat.st_mode, src_stat.st_rdev)
+    os.chown(dst, src_stat.st_uid, src_stat.st_gid)
+    # set mode after chown(), because it clears setuid and setgid bits
+    os.chmod(dst, S_IMODE(src_stat.st_mode))
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return dst
+
+
+def copytree_preserve(src: str, dst: str) -> None:
+    """Copy a directory recursively, preserving metadata and ownership
+    (like "cp -pr" does)
+
+    Args:
+        src (str): a path to the source directory
+        dst (str): a path to the destination directory
+
+    Raises:
+        shutil.Error: if some entries could not be copied
+    """
+    copy_error: Optional[Error] = None
+    try:
+        copytree(src, dst, symlinks=True, copy_function=copy_with_owner)
+    except Error as err:
+        # copytree() copies everything it can before reporting failures,
+        # so ownership of the copied part is still restored below
+        copy_error = err
+    # regular files are handled by the copy function, but directories and
+    # symlinks must be chowned separately
+    for root, dirs, files in os.walk(src):
+        dst_root: str = os.path.join(dst, os.path.relpath(root, src))
+        items: list[str] = ["."] if root == src else []
+        items.extend(dirs)
+        items.extend(f for f in files if os.path.islink(os.path.join(root, f)))
+        for item in items:
+            item_stat = os.lstat(os.path.join(root, item))
+            try:
+                os.chown(
+                    os.path.normpath(os.path.join(dst_root, item)),
+                    item_stat.st_uid,
+                    item_stat.st_gid,
+                    follow_symlinks=False,
+                )
+            except FileNotFoundError:
+                # failed to copy, already reported by copytree()
+                pass
+    if copy_error:
+        raise copy_error
+
+
+def copy_kernel_files(dst: str) -> None:
+    """Copy kernel files of the running system
+
+    Args:
+        dst (str): a path to the destination directory
+    """
+    # scandir() entries know their type, so stat() is needed only to
+    # follow symlinks
+    with os.scandir(DIR_KERNEL_SRC) as kernel_dir:
+        kernel_files: list[str] = [
+            file.path for file in kernel_dir if file.is_file()
+        ]
+    if not kernel_files:
+        return
+    # all the files are passed to a single cp call to avoid copying them
+    # one by one in Python. Symlinks are dereferenced, so the target gets
+    # real files
+    run(["cp", "-pL", *kernel_files, f"{dst}/"], check=True)
+    LOG.info(f"{', '.join(kernel_files)} installed into {dst}/")
+
+
 def prepare_tmp_disr() -> None:
     """Create temporary directories for installation"""
     dirpath = Path(DIR_DST_ROOT)
     dirpath.mkdir(mode=0o755, parents=True)
 
 
-def cleanup(mounts: list[str] = [], remove_items: list[str] = []) -> None:
+def cleanup(
+    mounts: Optional[list[str]] = None,
+    remove_items: Optional[list[str]] = None,
+) -> None:
     """Clean up after installation
 
     Args:
         mounts (list[str], optional): List of mounts to unmount.
-        Defaults to [].
+        Defaults to None.
         remove_items (list[str], optional): List of files or directories
-        to remove. Defaults to [].
+        to remove. Defaults to None.
     """
+    # use own lists to not modify the ones passed by a caller
+    mounts = list(mounts) if mounts else []
+    remove_items = list(remove_items) if remove_items else []
     LOG.debug("Cleaning up")
     # clean up installation directory by default
-    mounts_all = disk_partitions(all=True)
-    for mounted_device in mounts_all:
-        if mounted_device.mountpoint.startswith(DIR_INSTALLATION) and not (
-            mounted_device.device in mounts or mounted_device.mountpoint in mounts
-        ):
-            mounts.append(mounted_device.mountpoint)
+    with open("/proc/self/mounts") as mounts_file:
+        for mount_line in mounts_file:
+            device, mountpoint = mount_line.split(" ", 2)[:2]
+            # the installation dir has no characters which need escaping,
+            # so escaped mountpoints can be filtered by it as they are
+            if not mountpoint.startswith(DIR_INSTALLATION):
+                continue
+            # spaces, tabs and backslashes are octal-escaped in mounts
+            if "\\" in device or "\\" in mountpoint:
+                device, mountpoint = (
+                    re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), field)
+                    for field in (device, mountpoint)
+                )
+            if not (device in mounts or mountpoint in mounts):
+                mounts.append(mountpoint)
     # add installation dir to cleanup list
     if DIR_INSTALLATION not in remove_items:
         remove_items.append(DIR_INSTALLATION)
@@ -123,16 +260,21 @@ def cleanup(mounts: list[str] = [], remove_items: list[str] = []) -> None:
         LOG.debug("Unmounting target filesystems")
         for mountpoint in mounts:
             disk.partition_umount(mountpoint)
-        for mountpoint in mounts:
-            disk.wait_for_umount(mountpoint)
+        # mountpoints are independent, so wait for all of them at once
+        with ThreadPoolExecutor(max_workers=len(mounts)) as executor:
+            list(executor.map(disk.wait_for_umount, mounts))
     if remove_items:
         LOG.debug("Removing temporary files")
         for remove_item in remove_items:
-            if Path(remove_item).exists():
-                if Path(remove_item).is_file():
-                    Path(remove_item).unlink()
-                if Path(remove_item).is_dir():
-                    rmtree(remove_item, ignore_errors=True)
+            item_path = Path(remove_item)
+            try:
+                item_stat = item_path.lstat()
+            except FileNotFoundError:
+                continue
+            if S_ISDIR(item_stat.st_mode):
+                rmtree(item_path, ignore_errors=True)
+            else:
+                item_path.unlink(missing_ok=True)
 
 
 def setup_grub(root_dir: str, vars: dict[str, str]) -> None:
@@ -179,11 +321,16 @@ def handle(name: str, cfg, cloud: Cloud, log, args: list) -> None:
         return
 
     # add prefix to partitions if needed
-    part_prefix: str = ""
-    for dev_type in ["nvme", "mmcblk"]:
-        if dev_type in install_target:
-            part_prefix = "p"
-    LOG.info(f"System will be installed to {install_target} ({target_size} bytes)")
+    part_prefix: str = (
+        "p"
+        if os.path.basename(install_target).startswith(PARTITION_P_DEVICES)
+        else ""
+    )
+    part_efi: str = f"{install_target}{part_prefix}2"
+    part_root: str = f"{install_target}{part_prefix}3"
+    LOG.info(
+        f"System will be installed to {install_target} ({target_size} bytes)"
+    )
 
     # define target rootfs size in KB (smallest unit acceptable by sgdisk)
     rootfs_size: int = (target_size - CONST_RESERVED_SPACE) // 1024
@@ -194,45 +341,65 @@ def handle(name: str, cfg, cloud: Cloud, log, args: list) -> None:
     LOG.info("Disk cleaned")
     disk.parttable_create(install_target, rootfs_size)
     LOG.info("Partition table created")
-    disk.filesystem_create(f"{install_target}{part_prefix}2", "efi")
-    LOG.info("EFI filesystem created")
-    disk.filesystem_create(f"{install_target}{part_prefix}3", "ext4")
-    LOG.info("Ext4 filesystem created")
+    # partitions are independent, so the small EFI filesystem can be created
+    # while the ext4 one is being created
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        efi_created = executor.submit(disk.filesystem_create, part_efi, "efi")
+        root_created = executor.submit(
+            disk.filesystem_create, part_root, "ext4"
+        )
+        efi_created.result()
+        LOG.info("EFI filesystem created")
+        root_created.result()
+        LOG.info("Ext4 filesystem created")
 
     # create directiroes for installation media
     prepare_tmp_disr()
     LOG.info("Prepared temporary folders for installation")
 
+    # define paths on the target filesystem
+    dir_boot_efi: str = f"{DIR_DST_ROOT}/boot/efi"
+    dir_image_boot: str = f"{DIR_DST_ROOT}/boot/{image_name}"
+
     # mount target filesystem and create required dirs inside
-    disk.partition_mount(f"{install_target}{part_prefix}3", DIR_DST_ROOT)
-    LOG.info(f"Partiton {install_target}{part_prefix}3 mouted to {DIR_DST_ROOT}")
-    Path(f"{DIR_DST_ROOT}/boot/efi").mkdir(parents=True)
-    disk.partition_mount(f"{install_target}{part_prefix}2", f"{DIR_DST_ROOT}/boot/efi")
-    LOG.info(
-        f"Partiton {install_target}{part_prefix}2 mouted to {DIR_DST_ROOT}/boot/efi"
-    )
+    disk.partition_mount(part_root, DIR_DST_ROOT)
+    LOG.info(f"Partiton {part_root} mouted to {DIR_DST_ROOT}")
+    Path(dir_boot_efi).mkdir(parents=True)
+    disk.partition_mount(part_efi, dir_boot_efi)
+    LOG.info(f"Partiton {part_efi} mouted to {dir_boot_efi}")
 
     # copy config
     # a config dir. It is the deepest one, so the comand will
     # create all the rest in a single step
-    target_config_dir: str = f"{DIR_DST_ROOT}/boot/{image_name}/rw/opt/vyatta/etc/"
+    target_config_dir: str = f"{dir_image_boot}/rw/opt/vyatta/etc/"
     Path(target_config_dir).mkdir(parents=True)
-    # we must use Linux cp command, because Python cannot preserve ownership
-    run(["cp", "-pr", "/opt/vyatta/etc/config", target_config_dir])
-    LOG.info("Configuration copied from running system")
+    # a failed copy must not stop the installation
+    try:
+        copytree_preserve(
+            "/opt/vyatta/etc/config", f"{target_config_dir}config"
+        )
+        LOG.info("Configuration copied from running system")
+    except OSError as err:
+        LOG.error(f"Failed to copy configuration from running system: {err}")
 
     # create a persistence.conf
-    Path(f"{DIR_DST_ROOT}/persistence.conf").write_text("/ union\n")
+    persistence_fd: int = os.open(
+        f"{DIR_DST_ROOT}/persistence.conf",
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o644,
+    )
+    try:
+        os.write(persistence_fd, b"/ union\n")
+    finally:
+        os.close(persistence_fd)
     LOG.info("Root filesystem marked as persistent")
 
     # copy system image and kernel files
-    for file in Path(DIR_KERNEL_SRC).iterdir():
-        if file.is_file():
-            copy(file, f"{DIR_DST_ROOT}/boot/{image_name}/")
-            LOG.info(f"{file} installed into {DIR_DST_ROOT}/boot/{image_name}/")
-    copy(FILE_ROOTFS_SRC, f"{DIR_DST_ROOT}/boot/{image_name}/{image_name}.squashfs")
+    copy_kernel_files(dir_image_boot)
+    copy_file(FILE_ROOTFS_SRC, f"{dir_image_boot}/{image_name}.squashfs")
     LOG.info(
-        f"{FILE_ROOTFS_SRC} installed into {DIR_DST_ROOT}/boot/{image_name}/{image_name}.squashfs"
+        f"{FILE_ROOTFS_SRC} installed into "
+        f"{dir_image_boot}/{image_name}.squashfs"
     )
 
     # configure GRUB
@@ -267,7 +434,7 @@ def handle(name: str, cfg, cloud: Cloud, log, args: list) -> None:
     grub.set_default(image_name, DIR_DST_ROOT)
 
     # install GRUB
-    grub.install(install_target, f"{DIR_DST_ROOT}/boot/", f"{DIR_DST_ROOT}/boot/efi")
+    grub.install(install_target, f"{DIR_DST_ROOT}/boot/", dir_boot_efi)
     LOG.info("GRUB installed")
 
     # sort inodes (to make GRUB read config files in alphabetical order)
@@ -277,16 +444,11 @@ def handle(name: str, cfg, cloud: Cloud, log, args: list) -> None:
     # check if we need to disable Cloud-init
     if get_cfg_by_path(cfg, "vyos_install/ci_disable", False):
         LOG.info("Disabling Cloud-init")
-        Path(f"{DIR_DST_ROOT}/boot/{image_name}/rw/etc/cloud").mkdir(parents=True)
-        Path(
-            f"{DIR_DST_ROOT}/boot/{image_name}/rw/etc/cloud/cloud-init.disabled"
-        ).touch()
+        Path(f"{dir_image_boot}/rw/etc/cloud").mkdir(parents=True)
+        Path(f"{dir_image_boot}/rw/etc/cloud/cloud-init.disabled").touch()
 
     # umount filesystems and remove temporary files
-    cleanup(
-        [f"{install_target}{part_prefix}2", f"{install_target}{part_prefix}3"],
-        ["/mnt/installation"],
-    )
+    cleanup([part_efi, part_root], ["/mnt/installation"])
     LOG.info("Temporary resources freed up")
 
     # check if we need to reboot
@@ -295,8 +457,13 @@ def handle(name: str, cfg, cloud: Cloud, log, args: list) -> None:
         script_file = Path(
             "/opt/vyatta/etc/config/scripts/vyos-postconfig-bootup.script"
         )
-        script_file_data: str = script_file.read_text() + "\nsystemctl reboot\n"
-        script_file.write_text(script_file_data)
-
-    # sync just in case
-    sync()
+        # do not create the script if it is missing, it would not be
+        # executable and the reboot would silently not happen
+        try:
+            with script_file.open("r+b") as script:
+                script.seek(0, os.SEEK_END)
+                script.write(b"\nsystemctl reboot\n")
+        except FileNotFoundError:
+            LOG.error(
+                f"Reboot trigger was not added: {script_file} is missing"
+            )
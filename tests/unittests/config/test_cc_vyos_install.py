@@ -0,0 +1,257 @@
+# This file is part of cloud-init. See LICENSE file for license information.
+
+import errno
+import os
+import shutil
+import stat
+
+import pytest
+
+from cloudinit.config import cc_vyos_install
+from tests.unittests.helpers import mock
+
+M_PATH = "cloudinit.config.cc_vyos_install."
+
+
+def _raise_oserror(code):
+    def _raise(*args, **kwargs):
+        raise OSError(code, os.strerror(code))
+
+    return _raise
+
+
+class TestCopyFile:
+    @pytest.fixture
+    def src(self, tmp_path):
+        src = tmp_path / "filesystem.squashfs"
+        src.write_bytes(os.urandom(256 * 1024))
+        src.chmod(0o640)
+        return src
+
+    def _assert_copied(self, src, dst):
+        assert src.read_bytes() == dst.read_bytes()
+        assert 0o640 == dst.stat().st_mode & 0o777
+
+    def test_copy_file_range(self, src, tmp_path):
+        dst = tmp_path / "dst.squashfs"
+        with mock.patch(
+            M_PATH + "os.sendfile", side_effect=AssertionError
+        ), mock.patch(M_PATH + "copyfileobj", side_effect=AssertionError):
+            cc_vyos_install.copy_file(str(src), str(dst))
+        self._assert_copied(src, dst)
+
+    @pytest.mark.parametrize("code", [errno.EXDEV, errno.ENOSYS])
+    def test_sendfile_fallback(self, code, src, tmp_path):
+        dst = tmp_path / "dst.squashfs"
+        with mock.patch(
+            M_PATH + "os.copy_file_range", side_effect=_raise_oserror(code)
+        ), mock.patch(M_PATH + "copyfileobj", side_effect=AssertionError):
+            cc_vyos_install.copy_file(str(src), str(dst))
+        self._assert_copied(src, dst)
+
+    @pytest.mark.parametrize("code", [errno.EXDEV, errno.ENOSYS])
+    def test_copyfileobj_fallback(self, code, src, tmp_path):
+        dst = tmp_path / "dst.squashfs"
+        with mock.patch(
+            M_PATH + "os.copy_file_range", side_effect=_raise_oserror(code)
+        ), mock.patch(
+            M_PATH + "os.sendfile", side_effect=_raise_oserror(code)
+        ):
+            cc_vyos_install.copy_file(str(src), str(dst))
+        self._assert_copied(src, dst)
+
+    def test_zero_copy_file_range_falls_back(self, src, tmp_path):
+        """copy_file_range() returning 0 for a non-empty file is not EOF."""
+        dst = tmp_path / "dst.squashfs"
+        with mock.patch(
+            M_PATH + "os.copy_file_range", return_value=0
+        ), mock.patch(M_PATH + "os.sendfile", wraps=os.sendfile) as m_sendfile:
+            cc_vyos_install.copy_file(str(src), str(dst))
+        assert m_sendfile.called
+        self._assert_copied(src, dst)
+
+    def test_incomplete_copy_raises(self, src, tmp_path):
+        dst = tmp_path / "dst.squashfs"
+        with mock.patch(
+            M_PATH + "os.copy_file_range", return_value=0
+        ), mock.patch(M_PATH + "os.sendfile", return_value=0), mock.patch(
+            M_PATH + "copyfileobj"
+        ):
+            with pytest.raises(OSError, match="copied incompletely"):
+                cc_vyos_install.copy_file(str(src), str(dst))
+
+    def test_empty_file(self, tmp_path):
+        src = tmp_path / "empty"
+        src.touch()
+        dst = tmp_path / "dst"
+        cc_vyos_install.copy_file(str(src), str(dst))
+        assert b"" == dst.read_bytes()
+
+    def test_other_errors_are_raised(self, src, tmp_path):
+        dst = tmp_path / "dst.squashfs"
+        with mock.patch(
+            M_PATH + "os.copy_file_range",
+            side_effect=_raise_oserror(errno.EIO),
+        ):
+            with pytest.raises(OSError):
+                cc_vyos_install.copy_file(str(src), str(dst))
+
+
+class TestCopytreePreserve:
+    @pytest.fixture
+    def src(self, tmp_path):
+        src = tmp_path / "config"
+        (src / "scripts").mkdir(parents=True)
+        (src / "config.boot").write_text("system {}\n")
+        (src / "scripts" / "postconfig.script").write_text("#!/bin/sh\n")
+        (src / "scripts" / "postconfig.script").chmod(0o4755)
+        (src / "scripts").chmod(0o2775)
+        (src / "config.link").symlink_to("config.boot")
+        return src
+
+    def test_modes_and_symlinks(self, src, tmp_path):
+        dst = tmp_path / "dst"
+        cc_vyos_install.copytree_preserve(str(src), str(dst))
+        assert "system {}\n" == (dst / "config.boot").read_text()
+        assert (
+            0o4755
+            == (dst / "scripts" / "postconfig.script").stat().st_mode & 0o7777
+        )
+        assert 0o2775 == (dst / "scripts").stat().st_mode & 0o7777
+        assert "config.boot" == os.readlink(dst / "config.link")
+        assert (src / "config.boot").stat().st_mtime_ns == (
+            dst / "config.boot"
+        ).stat().st_mtime_ns
+
+    @pytest.mark.skipif(os.geteuid() != 0, reason="chown requires root")
+    def test_ownership(self, src, tmp_path):
+        for path in (src, src / "scripts", src / "config.boot"):
+            os.chown(path, 1000, 100)
+        os.chown(src / "config.link", 1000, 100, follow_symlinks=False)
+        os.chmod(src / "config.boot", 0o4755)
+        dst = tmp_path / "dst"
+        cc_vyos_install.copytree_preserve(str(src), str(dst))
+        for path in (".", "scripts", "config.boot", "config.link"):
+            dst_stat = os.lstat(dst / path)
+            assert (1000, 100) == (dst_stat.st_uid, dst_stat.st_gid), path
+        # chown() must not drop the setuid bit
+        assert 0o4755 == (dst / "config.boot").stat().st_mode & 0o7777
+
+    def test_fifo_recreated(self, src, tmp_path):
+        """FIFOs are recreated like "cp -R" does instead of failing."""
+        os.mkfifo(src / "fifo", 0o640)
+        dst = tmp_path / "dst"
+        cc_vyos_install.copytree_preserve(str(src), str(dst))
+        fifo_mode = (dst / "fifo").lstat().st_mode
+        assert stat.S_ISFIFO(fifo_mode)
+        assert 0o640 == stat.S_IMODE(fifo_mode)
+        assert (dst / "scripts" / "postconfig.script").exists()
+
+    def test_copy_errors_reported(self, src, tmp_path):
+        """Entries which cannot be copied are reported after the rest of
+        the tree is copied."""
+        (src / "unreadable").write_text("")
+        dst = tmp_path / "dst"
+        real_copyfile = shutil.copyfile
+
+        def copyfile(src_file, dst_file):
+            if src_file.endswith("unreadable"):
+                raise PermissionError(errno.EACCES, "denied", src_file)
+            return real_copyfile(src_file, dst_file)
+
+        with mock.patch(M_PATH + "copyfile", side_effect=copyfile):
+            with pytest.raises(shutil.Error):
+                cc_vyos_install.copytree_preserve(str(src), str(dst))
+        assert not (dst / "unreadable").exists()
+        assert (dst / "scripts" / "postconfig.script").exists()
+
+
+class TestFindDisk:
+    @pytest.mark.parametrize(
+        "lsblk_out,expected",
+        [
+            pytest.param("", ("", 0), id="empty"),
+            pytest.param(
+                "/dev/sr0 rom 4294967296\n", ("", 0), id="rom_not_disk"
+            ),
+            pytest.param(
+                "/dev/vda disk 2147483648\n", ("", 0), id="too_small"
+            ),
+            pytest.param(
+                "/dev/sr0 rom 4294967296\n"
+                "/dev/sda disk 1073741824\n"
+                "/dev/nvme0n1 disk 10737418240\n"
+                "/dev/vdb disk 21474836480\n",
+                ("/dev/nvme0n1", 10737418240),
+                id="first_suitable_disk",
+            ),
+        ],
+    )
+    @mock.patch(M_PATH + "run")
+    def test_find_disk(self, m_run, lsblk_out, expected):
+        m_run.return_value.stdout = lsblk_out
+        assert expected == cc_vyos_install.find_disk()
+        assert ["lsblk", "-rnbdpo", "NAME,TYPE,SIZE"] == m_run.call_args[0][0]
+
+
+PROC_MOUNTS = """\
+/dev/vda1 / ext4 rw,relatime 0 0
+proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0
+/dev/sda3 {installation_dir}/disk_dst ext4 rw,relatime 0 0
+/dev/sda2 {installation_dir}/disk_dst/boot/efi vfat rw,relatime 0 0
+/dev/sdb1 {installation_dir}/with\\040space ext4 rw,relatime 0 0
+/dev/sdc1 /mnt/other ext4 rw,relatime 0 0
+"""
+
+
+class TestCleanup:
+    @pytest.fixture(autouse=True)
+    def installation_dir(self, tmp_path):
+        installation_dir = tmp_path / "installation"
+        installation_dir.mkdir()
+        proc_mounts = PROC_MOUNTS.format(installation_dir=installation_dir)
+        with mock.patch(
+            M_PATH + "DIR_INSTALLATION", str(installation_dir)
+        ), mock.patch(
+            M_PATH + "open", mock.mock_open(read_data=proc_mounts), create=True
+        ):
+            yield installation_dir
+
+    @pytest.fixture
+    def m_disk(self):
+        with mock.patch(M_PATH + "disk", create=True) as m_disk:
+            yield m_disk
+
+    def _umounted(self, m_disk):
+        return [c.args[0] for c in m_disk.partition_umount.call_args_list]
+
+    def test_only_installation_mounts_added(self, m_disk, installation_dir):
+        """Mounts outside the installation dir are left alone, mounts passed
+        by device are not added again and escaped paths are decoded."""
+        cc_vyos_install.cleanup(["/dev/sda2", "/dev/sda3"])
+        assert [
+            "/dev/sda2",
+            "/dev/sda3",
+            f"{installation_dir}/with space",
+        ] == self._umounted(m_disk)
+
+    def test_waits_for_all_umounts(self, m_disk):
+        cc_vyos_install.cleanup(["/dev/sda2", "/dev/sda3"])
+        assert sorted(self._umounted(m_disk)) == sorted(
+            c.args[0] for c in m_disk.wait_for_umount.call_args_list
+        )
+
+    def test_installation_dir_removed(self, m_disk, installation_dir):
+        (installation_dir / "disk_dst").mkdir()
+        leftover = installation_dir.parent / "leftover"
+        leftover.touch()
+        cc_vyos_install.cleanup(remove_items=[str(leftover)])
+        assert not installation_dir.exists()
+        assert not leftover.exists()
+
+    def test_caller_lists_not_modified(self, m_disk, tmp_path):
+        mounts = ["/dev/sda2"]
+        remove_items = [str(tmp_path / "nonexistent")]
+        cc_vyos_install.cleanup(mounts, remove_items)
+        assert ["/dev/sda2"] == mounts
+        assert [str(tmp_path / "nonexistent")] == remove_items